@@ -1,3 +1,11 @@
+from importlib.metadata import version, PackageNotFoundError
+
+try:
+    __version__ = version('bioimageit-cid')
+except PackageNotFoundError:
+    # package not installed, ex: running from a source checkout
+    __version__ = 'unknown'
+
 from .data_cid import plugin_info, CIDMetadataService, CIDMetadataServiceBuilder
 
 __all__ = ['CIDMetadataService',
@@ -14,8 +14,36 @@ CIDMetadataService
 import numpy as np
 import os
 import os.path
+import gzip
 import json
+import logging
+import tempfile
+import time
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+try:
+    import ijson
+    _JSON_ERRORS = (ValueError, ijson.JSONError)
+    try:
+        ijson = ijson.get_backend('yajl2_c')
+    except ImportError:
+        pass
+except ImportError:
+    ijson = None
+    _JSON_ERRORS = (ValueError,)
 
 from bioimageit_formats import FormatsAccess, formatsServices
 
@@ -35,6 +63,9 @@ from bioimageit_core.containers.data_containers import (METADATA_TYPE_RAW,
                                                         DatasetInfo,
                                                         )
 
+from bioimageit_cid import __version__
+
+_log = logging.getLogger(__name__)
 
 
 plugin_info = {
@@ -43,31 +74,168 @@ plugin_info = {
     'builder': 'CIDMetadataServiceBuilder'
 }
 
+TOKEN_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache',
+                                'bioimageit_cid', 'token.json')
+EXPERIMENT_CACHE_SIZE = 128
+EXPERIMENT_CACHE_TTL = 60
+POOL_MAXSIZE = 20
+COMPRESS_MIN_SIZE = 1024
+
+# serializes the read-modify-write of the tokens cache file
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+# request headers removing the session Authorization header
+_NO_AUTHORIZATION = {'Authorization': None}
+
+# HTTP adapter shared by the services sessions, so that they reuse the same
+# urllib3 connection pools
+_ADAPTER = None
+_ADAPTER_LOCK = threading.Lock()
+
+
+def _get_adapter():
+    """Get the shared HTTP adapter, created on the first call"""
+    global _ADAPTER
+    with _ADAPTER_LOCK:
+        if _ADAPTER is None:
+            _ADAPTER = HTTPAdapter(
+                pool_connections=10, pool_maxsize=POOL_MAXSIZE,
+                max_retries=Retry(total=3, backoff_factor=0.3,
+                                  status_forcelist=[502, 503, 504],
+                                  raise_on_status=False))
+        return _ADAPTER
+
+
+@functools.lru_cache(maxsize=64)
+def _format_extension(format_):
+    """Get the file extension of a data format"""
+    return FormatsAccess.instance().get(format_).extension
+
+
+def _response_projects(res):
+    """Get the list of projects of a get_data.php response
+
+    The server may return the projects as a list, or a single project as an
+    object. Responses without projects give an empty list
+
+    """
+    projects = res.get('projects') if isinstance(res, dict) else None
+    if not projects:
+        return []
+    if isinstance(projects, dict):
+        return [projects]
+    return projects
+
+
+@dataclass(frozen=True)
+class _ExperimentView:
+    """Immutable record of an experiment metadata, stored in the cache
+
+    The datasets are stored as (name, uri, uuid) tuples. Use to_container
+    to get an Experiment
+
+    """
+    __slots__ = ('uuid', 'md_uri', 'name', 'author', 'date', 'raw_dataset',
+                 'processed_datasets')
+    uuid: str
+    md_uri: str
+    name: str
+    author: str
+    date: str
+    raw_dataset: tuple
+    processed_datasets: tuple
+
+    @classmethod
+    def from_project(cls, project):
+        """Create the view from a project as returned by the CID API"""
+        raw_dataset = None
+        processed_datasets = []
+        for dataset in project.get('datasets', []):
+            info = (dataset['label'], dataset['id'], dataset['id'])
+            if dataset['label'] == 'data':
+                raw_dataset = info
+            else:
+                processed_datasets.append(info)
+        return cls(project['id'], project['id'], project['label'],
+                   project['owner'], project['date'], raw_dataset,
+                   tuple(processed_datasets))
+
+    def to_container(self):
+        """Create a new Experiment container with the view metadata"""
+        container = Experiment()
+        container.uuid = self.uuid
+        container.md_uri = self.md_uri
+        container.name = self.name
+        container.author = self.author
+        container.date = self.date
+        if self.raw_dataset is not None:
+            container.raw_dataset = DatasetInfo(*self.raw_dataset)
+        container.processed_datasets = [DatasetInfo(*info) for info in
+                                        self.processed_datasets]
+        return container
+
 
 class CIDMetadataServiceBuilder:
     """Service builder for the metadata service"""
 
     def __init__(self):
-        self._instance = None
+        self._instances = {}
 
     def __call__(self, host, username, password):
-        if not self._instance:
-            self._instance = CIDMetadataService(host, username, password)
-        return self._instance
+        key = (host, username)
+        if key not in self._instances:
+            self._instances[key] = CIDMetadataService(host, username, password)
+        return self._instances[key]
 
 
 class CIDMetadataService:
     """Service for local metadata management"""
 
-    def __init__(self, host, username, password):
+    def __init__(self, host, username, password, timeout=30,
+                 compress_requests=False):
         self.service_name = 'CIDMetadataService'
         self._host = host
+        self._base_url = host.rstrip('/') + '/'
         self._username = username
         self._password = password
+        self._timeout = timeout
+        # the server must support gzip request bodies: off unless known
+        self._compress_requests = compress_requests
         self.token = None
-        self._cid_connect()        
+        self._connect_lock = threading.Lock()
+        self._experiment_cache = OrderedDict()
+        self._experiment_cache_lock = threading.Lock()
+        self._workspace_prefix = None
+        self._session = self._create_session()
+        if not self._load_cached_token():
+            self._cid_connect()
+
+    @staticmethod
+    def _create_session():
+        """Create the HTTP session of the service
+
+        The session holds the service headers (Authorization), and the
+        connections pools are shared by all the services
+
+        """
+        session = requests.Session()
+        adapter = _get_adapter()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        """Close the HTTP session
+
+        The shared connections pools are left open for the other services
+
+        """
+        self._session.adapters.clear()
+        self._session.close()
 
-    def _send_request(self, url, verb, params, use_token=True):
+    def _send_request(self, url, verb, params, use_token=True, stream=False,
+                      json_body=False, compress=True, headers=None,
+                      return_response=False):
         """Send a REST request using the requests library
 
         Parameters
@@ -79,49 +247,171 @@ class CIDMetadataService:
         params: dict
             value of the parameter in the request
         use_token: bool          
-            True to add an Authorization header in the request 
-        
+            True to send the session Authorization header with the request
+        stream: bool
+            True to return the response without reading its body, so that
+            it can be parsed while it is downloaded. The caller must close it
+        json_body: bool
+            True to send the parameters as a JSON body instead of a form
+        compress: bool
+            True to gzip a JSON body larger than COMPRESS_MIN_SIZE bytes when
+            the service was created with compress_requests. If the server
+            answers 415 the request is sent again uncompressed, and the
+            service stops compressing requests
+        headers: dict
+            Additional headers of the request
+        return_response: bool
+            True to return a (result, response) tuple, to read the response
+            headers
+
+        Returns
+        -------
+        The decoded JSON body, True if the response has no body, or None
+        if the server answered 304 Not Modified
+
         """
-        url = f"{self._host}/{url}"
-        
-        # instantiate request
-        method_map = {
-            'GET': (requests.get, {}),
-            'POST': (requests.post, {}),
-            'DELETE': (requests.delete, {}),
-        }
-        requests_method, headers = method_map[verb]
-        if use_token:
-            headers.update({'Authorization': self.token})
-        kwargs = {'headers': headers, 'data': params}
+        url = self._base_url + url
+
+        # the Authorization header is set on the session once connected
+        if not use_token:
+            headers = {**headers, **_NO_AUTHORIZATION} if headers \
+                else _NO_AUTHORIZATION
+        if json_body:
+            params = json_dumps(params)
+            headers = {**(headers or {}), 'Content-Type': 'application/json'}
 
         # run the request
-        req = requests_method(url, **kwargs)
+        token = self.token
+        compressed = (compress and self._compress_requests
+                      and isinstance(params, bytes)
+                      and len(params) > COMPRESS_MIN_SIZE)
+        req = self._request(verb, url, params, headers, stream, compressed)
+        if compressed and req.status_code == 415:
+            req.close()
+            self._compress_requests = False
+            compressed = False
+            req = self._request(verb, url, params, headers, stream, compressed)
+
+        # the token may have expired: authenticate again and retry once
+        if use_token and req.status_code in (401, 403):
+            req.close()
+            self._reconnect(token)
+            req = self._request(verb, url, params, headers, stream, compressed)
 
         # check if error
         if not req.ok:
+            req.close()
             raise DataServiceError(f'CID communication error: {req.status_code}')
 
-        if req.status_code == 204:
-            return True
+        if stream:
+            req.raw.decode_content = True
+            return req
 
-        return req.json        
+        if req.status_code == 304:
+            res = None
+        elif req.status_code == 204 or not req.content:
+            res = True
+        else:
+            res = json_loads(req.content)
+        return (res, req) if return_response else res
 
 
+    def _request(self, verb, url, body, headers, stream, compressed):
+        """Run a request with the session, gzipping the body if compressed"""
+        if compressed:
+            headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+            body = gzip.compress(body)
+        return self._session.request(verb, url, headers=headers, data=body,
+                                     timeout=self._timeout, stream=stream)
+
     def _cid_connect(self):
         """Get the session token"""
-        print('CID connect')
+        _log.debug('CID connect host=%s user=%s', self._host, self._username)
 
         params = {'username': self._username, 'password': self._password}
         res = self._send_request('authenticate.php', 'POST', params, use_token=False)
 
-        if 'httpHeaderValue' in res:
+        if isinstance(res, dict) and 'httpHeaderValue' in res:
             self.token = res['httpHeaderValue']
+            self._session.headers['Authorization'] = self.token
+            self._save_cached_token()
         else:
             raise DataServiceError(
                 'Unable to connect to the CID database'
             )
 
+    def _reconnect(self, expired_token):
+        """Get a new session token after a request was refused
+
+        Concurrent requests refused with the same token authenticate only
+        once: the others wait and reuse the new token
+
+        Parameters
+        ----------
+        expired_token: str
+            Token used by the refused request
+
+        """
+        with self._connect_lock:
+            if self.token == expired_token:
+                self._cid_connect()
+
+    def _token_cache_key(self):
+        return f"{self._username}@{self._host}"
+
+    def _read_token_cache(self):
+        """Read the tokens cache file"""
+        try:
+            with open(TOKEN_CACHE_FILE, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_cached_token(self):
+        """Set the token from the cache file if any
+
+        Returns
+        -------
+        True if a token was found in the cache, False otherwise
+
+        """
+        entry = self._read_token_cache().get(self._token_cache_key())
+        if not isinstance(entry, dict) or entry.get('version') != __version__ \
+                or not entry.get('token'):
+            return False
+        self.token = entry['token']
+        self._session.headers['Authorization'] = self.token
+        return True
+
+    def _save_cached_token(self):
+        """Write the current token to the cache file
+
+        The cache is an optimization: failing to write it is not an error
+
+        """
+        cache_dir = os.path.dirname(TOKEN_CACHE_FILE)
+        with _TOKEN_CACHE_LOCK:
+            cache = self._read_token_cache()
+            cache[self._token_cache_key()] = {'host': self._host,
+                                              'username': self._username,
+                                              'token': self.token,
+                                              'timestamp': time.time(),
+                                              'version': __version__}
+            # write a private temporary file and move it over the cache so
+            # that readers never see a partially written file
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as cache_file:
+                        json.dump(cache, cache_file)
+                    os.replace(tmp_path, TOKEN_CACHE_FILE)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            except OSError:
+                pass
+
     def needs_cleanning(self):
         return True
 
@@ -163,7 +453,42 @@ class CIDMetadataService:
         list of experiment containers  
           
         """
-        raise NotImplementedError()   
+        return list(self.iter_workspace_experiments(workspace_uri))
+
+    def iter_workspace_experiments(self, workspace_uri=''):
+        """Iterate over the experiments in the user workspace
+
+        The response is parsed while it is downloaded, so the experiments
+        are yielded without loading the full list in memory
+
+        Parameters
+        ----------
+        workspace_uri: str
+            URI of the workspace
+
+        Returns
+        -------
+        generator of experiment containers
+
+        """
+        params = {"action": "projects"}
+        response = self._send_request('get_data.php', 'GET', params,
+                                      stream=True)
+        try:
+            # use_float: numbers are int or float, as with json_loads
+            if ijson is not None:
+                projects = ijson.items(response.raw, 'projects.item',
+                                       use_float=True)
+            else:
+                projects = _response_projects(json_loads(response.content))
+            for project in projects:
+                yield _ExperimentView.from_project(project).to_container()
+        except _JSON_ERRORS:
+            raise DataServiceError(
+                'CID communication error: invalid experiments list'
+            )
+        finally:
+            response.close()
 
     def get_experiment(self, md_uri):
         """Read an experiment from the database
@@ -180,31 +505,149 @@ class CIDMetadataService:
         Experiment container with the experiment metadata
 
         """
-
-        params= {"action": "project",
-	             "parameter": "id_project",
-	             "value": md_uri
-                }
-
-        params = {'username': self._username, 'password': self._password}
-        res = self._send_request('get_data.php', 'GET', params)
-
-        container = Experiment()
-        if 'projects' in res and len(res['projects']) > 0:
-            project = res['projects']
-            container.uuid = project['id']    
-            container.md_uri = project['id']
-            container.name = project['label']
-            container.author = project['owner']
-            container.date = project['date']
-
-            # TODO add request to get the list of datasets in this project
-            
+        cached = self._get_cached_experiment(md_uri)
+        if cached is not None and cached[2]:
+            return cached[0].to_container()
+
+        # the server filters the project: only the matching one is returned
+        params = {"action": "project",
+                  "parameter": "id_project",
+                  "value": md_uri,
+                  "include": "datasets"}
+        # an expired entry is revalidated with its ETag: if the experiment
+        # did not change the server answers 304 without body
+        headers = None
+        if cached is not None and cached[1]:
+            headers = {'If-None-Match': cached[1]}
+        res, response = self._send_request('get_data.php', 'GET', params,
+                                           headers=headers,
+                                           return_response=True)
+        etag = response.headers.get('ETag')
+        projects = _response_projects(res)
+        if res is None and cached is not None:
+            view = cached[0]
+            etag = etag or cached[1]
+        elif projects:
+            view = _ExperimentView.from_project(projects[0])
         else:
             raise DataServiceError(
                 f'Unable to find the experiment {md_uri}'
             )
-        return container
+        self._cache_experiment(md_uri, view, etag)
+        return view.to_container()
+
+    def get_experiments(self, md_uris, include_datasets=True):
+        """Read a list of experiments from the database in a single request
+
+        Parameters
+        ----------
+        md_uris: list
+            URIs of the experiments
+        include_datasets: bool
+            True to also read the list of datasets of each experiment
+
+        Returns
+        -------
+        list of experiment containers, in the order of md_uris
+
+        """
+        experiments = {}
+        missing = []
+        for md_uri in md_uris:
+            cached = self._get_cached_experiment(md_uri)
+            if cached is not None and cached[2]:
+                experiments[md_uri] = cached[0]
+            elif md_uri not in missing:
+                missing.append(md_uri)
+
+        if missing:
+            params = {"action": "projects", "ids": missing}
+            if include_datasets:
+                params["include"] = "datasets"
+            res = self._send_request('get_data.php', 'POST', params,
+                                     json_body=True)
+
+            projects = {}
+            for project in _response_projects(res):
+                projects[str(project['id'])] = project
+            for md_uri in missing:
+                if str(md_uri) not in projects:
+                    raise DataServiceError(
+                        f'Unable to find the experiment {md_uri}'
+                    )
+                view = _ExperimentView.from_project(projects[str(md_uri)])
+                experiments[md_uri] = view
+                # the cache holds complete experiments only
+                if include_datasets:
+                    self._cache_experiment(md_uri, view)
+
+        return [experiments[md_uri].to_container() for md_uri in md_uris]
+
+    def get_experiments_parallel(self, md_uris, max_workers=8):
+        """Read a list of experiments with concurrent requests
+
+        Each experiment is read with get_experiment in a worker thread. The
+        workers share the service session, so its connection pool reuses
+        the connections to the host across threads. max_workers is limited
+        to the pool size (POOL_MAXSIZE)
+
+        Parameters
+        ----------
+        md_uris: list
+            URIs of the experiments
+        max_workers: int
+            Maximum number of concurrent requests
+
+        Returns
+        -------
+        list of experiment containers, in the order of md_uris
+
+        """
+        max_workers = max(1, min(max_workers, POOL_MAXSIZE))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.get_experiment, md_uris))
+
+    def _get_cached_experiment(self, md_uri):
+        """Get an experiment from the cache
+
+        Returns
+        -------
+        None if not cached, otherwise a (view, etag, fresh) tuple where
+        fresh is False if the entry is older than EXPERIMENT_CACHE_TTL
+
+        """
+        # the token is part of the cache key so that a re-authentication
+        # invalidates the previous entries
+        cache_key = (md_uri, self.token)
+        with self._experiment_cache_lock:
+            entry = self._experiment_cache.get(cache_key)
+            if entry is None:
+                return None
+            self._experiment_cache.move_to_end(cache_key)
+        view, etag, timestamp = entry
+        return view, etag, time.time() - timestamp < EXPERIMENT_CACHE_TTL
+
+    def _cache_experiment(self, md_uri, view, etag=None):
+        """Add an experiment view to the cache, dropping the least recently used"""
+        with self._experiment_cache_lock:
+            self._experiment_cache[(md_uri, self.token)] = (view, etag,
+                                                            time.time())
+            if len(self._experiment_cache) > EXPERIMENT_CACHE_SIZE:
+                self._experiment_cache.popitem(last=False)
+
+    def invalidate_experiment(self, md_uri):
+        """Remove an experiment from the experiments cache
+
+        Parameters
+        ----------
+        md_uri: str
+            URI of the experiment
+
+        """
+        with self._experiment_cache_lock:
+            for key in [key for key in self._experiment_cache
+                        if key[0] == md_uri]:
+                del self._experiment_cache[key]
 
     def update_experiment(self, experiment):
         """Write an experiment to the database
@@ -422,17 +865,26 @@ class CIDMetadataService:
         raise NotImplementedError()   
 
  
+    def _get_workspace_prefix(self):
+        """Get the workspace directory, ending with a separator, read once"""
+        if self._workspace_prefix is None:
+            workspace = ConfigAccess.instance().config['workspace']
+            self._workspace_prefix = os.path.join(workspace, '')
+        return self._workspace_prefix
+
+    def invalidate_cache(self):
+        """Forget the workspace and formats extensions read from the config"""
+        self._workspace_prefix = None
+        _format_extension.cache_clear()
+
     def get_data_uri(self, data_container):
-        workspace = ConfigAccess.instance().config['workspace']
-        extension = FormatsAccess.instance().get(data_container.format).extension
-        destination_input = os.path.join(workspace,f"{data_container.name}.{extension}")
-        return destination_input
+        extension = _format_extension(data_container.format)
+        return f"{self._get_workspace_prefix()}{data_container.name}.{extension}"
 
     def create_data_uri(self, dataset, run, processed_data):
-        workspace = ConfigAccess.instance().config['workspace']
-
-        extension = FormatsAccess.instance().get(processed_data.format).extension
-        processed_data.uri = os.path.join(workspace, f"{processed_data.name}.{extension}")
+        extension = _format_extension(processed_data.format)
+        processed_data.uri = \
+            f"{self._get_workspace_prefix()}{processed_data.name}.{extension}"
         return processed_data
 
     def create_data(self, dataset, run, processed_data):
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Tests of the CID metadata service requests, with a fake HTTP session"""
+import gzip
+import io
+import json
+
+import pytest
+
+pytest.importorskip('bioimageit_core')
+pytest.importorskip('bioimageit_formats')
+requests = pytest.importorskip('requests')
+
+from bioimageit_core.core.exceptions import DataServiceError
+
+from bioimageit_cid import data_cid
+from bioimageit_cid.data_cid import CIDMetadataService
+
+
+HOST = 'https://cid.example.org/api'
+PROJECT = {'id': '42', 'label': 'experiment', 'owner': 'user',
+           'date': '2022-01-01'}
+
+
+def make_response(status_code=200, body=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = b'' if body is None else json.dumps(body).encode()
+    response._content_consumed = True
+    response.headers.update(headers or {})
+    return response
+
+
+class RawBody(io.BytesIO):
+    """Streamed body of a fake response"""
+
+
+def make_stream_response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = RawBody(body)
+    return response
+
+
+class FakeServer:
+    """Answer the session requests with queued responses and record them"""
+
+    def __init__(self):
+        self.responses = []
+        self.calls = []
+
+    def queue(self, *responses):
+        self.responses.extend(responses)
+
+    def request(self, session, method, url, **kwargs):
+        self.calls.append({'method': method, 'url': url,
+                           'headers': {**session.headers,
+                                       **(kwargs.get('headers') or {})},
+                           'data': kwargs.get('data')})
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    fake = FakeServer()
+    monkeypatch.setattr(requests.Session, 'request',
+                        lambda session, method, url, **kwargs:
+                        fake.request(session, method, url, **kwargs))
+    monkeypatch.setattr(data_cid, 'TOKEN_CACHE_FILE',
+                        str(tmp_path / 'token.json'))
+    return fake
+
+
+def auth_response(token='token1'):
+    return make_response(body={'httpHeaderValue': token})
+
+
+@pytest.fixture
+def service(server):
+    server.queue(auth_response())
+    cid_service = CIDMetadataService(HOST, 'user', 'password')
+    server.calls.clear()
+    return cid_service
+
+
+def test_send_request_no_content(server, service):
+    server.queue(make_response(204))
+    assert service._send_request('get_data.php', 'GET', {}) is True
+
+
+def test_send_request_empty_body(server, service):
+    server.queue(make_response(200))
+    assert service._send_request('get_data.php', 'GET', {}) is True
+
+
+def test_send_request_json_body(server, service):
+    server.queue(make_response(body={'projects': []}))
+    res = service._send_request('get_data.php', 'GET', {})
+    assert res == {'projects': []}
+
+
+def test_send_request_error(server, service):
+    server.queue(make_response(503))
+    with pytest.raises(DataServiceError):
+        service._send_request('get_data.php', 'GET', {})
+
+
+def test_authorization_header(server, service):
+    assert server.calls == []
+    server.queue(make_response(body={}))
+    service._send_request('get_data.php', 'GET', {})
+    assert server.calls[0]['url'] == f'{HOST}/get_data.php'
+    assert server.calls[0]['headers']['Authorization'] == 'token1'
+
+
+def test_token_cache(server, service):
+    # a new service reuses the token cached by the previous one
+    CIDMetadataService(HOST, 'user', 'password')
+    assert server.calls == []
+
+
+def test_connect_empty_response(server):
+    server.queue(make_response(200))
+    with pytest.raises(DataServiceError):
+        CIDMetadataService(HOST, 'user', 'password')
+
+
+def test_reconnect_on_unauthorized(server, service):
+    server.queue(make_response(401), auth_response('token2'),
+                 make_response(body={'projects': []}))
+    res = service._send_request('get_data.php', 'GET', {})
+    assert res == {'projects': []}
+    assert [call['url'] for call in server.calls] == \
+        [f'{HOST}/get_data.php', f'{HOST}/authenticate.php',
+         f'{HOST}/get_data.php']
+    assert server.calls[2]['headers']['Authorization'] == 'token2'
+
+
+def test_reconnect_once_per_expired_token(server, service):
+    # a request refused with an already replaced token does not authenticate
+    service.token = 'token2'
+    service._reconnect('token1')
+    assert server.calls == []
+
+
+def test_gzip_request_fallback(server):
+    server.queue(auth_response())
+    service = CIDMetadataService(HOST, 'user', 'password',
+                                 compress_requests=True)
+    server.calls.clear()
+    params = {'ids': [str(i) for i in range(500)]}
+    server.queue(make_response(415), make_response(body={}))
+    service._send_request('get_data.php', 'POST', params, json_body=True)
+
+    compressed, plain = server.calls
+    assert compressed['headers']['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed['data'])) == params
+    assert 'Content-Encoding' not in plain['headers']
+    assert json.loads(plain['data']) == params
+    assert not service._compress_requests
+
+
+def test_gzip_request_disabled_by_default(server, service):
+    params = {'ids': [str(i) for i in range(500)]}
+    server.queue(make_response(body={}))
+    service._send_request('get_data.php', 'POST', params, json_body=True)
+    assert 'Content-Encoding' not in server.calls[0]['headers']
+
+
+def test_get_experiment(server, service):
+    server.queue(make_response(body={'projects': [PROJECT]}))
+    experiment = service.get_experiment('42')
+    assert experiment.md_uri == '42'
+    assert experiment.name == 'experiment'
+
+
+def test_get_experiment_single_project(server, service):
+    server.queue(make_response(body={'projects': PROJECT}))
+    assert service.get_experiment('42').name == 'experiment'
+
+
+def test_get_experiment_not_found(server, service):
+    server.queue(make_response(200))
+    with pytest.raises(DataServiceError):
+        service.get_experiment('42')
+
+
+def test_get_experiment_cache(server, service):
+    server.queue(make_response(body={'projects': [PROJECT]}))
+    first = service.get_experiment('42')
+    first.name = 'changed'
+    second = service.get_experiment('42')
+    assert len(server.calls) == 1
+    assert second.name == 'experiment'
+
+
+def test_get_experiment_cache_size(server, service, monkeypatch):
+    monkeypatch.setattr(data_cid, 'EXPERIMENT_CACHE_SIZE', 2)
+    for md_uri in ('1', '2', '3'):
+        server.queue(make_response(body={'projects': [{**PROJECT,
+                                                       'id': md_uri}]}))
+        service.get_experiment(md_uri)
+    assert service._get_cached_experiment('1') is None
+    assert service._get_cached_experiment('3') is not None
+
+
+def test_get_experiment_etag(server, service, monkeypatch):
+    monkeypatch.setattr(data_cid, 'EXPERIMENT_CACHE_TTL', 0)
+    server.queue(make_response(body={'projects': [PROJECT]},
+                               headers={'ETag': '"v1"'}),
+                 make_response(304))
+    service.get_experiment('42')
+    experiment = service.get_experiment('42')
+    assert experiment.name == 'experiment'
+    assert 'If-None-Match' not in server.calls[0]['headers']
+    assert server.calls[1]['headers']['If-None-Match'] == '"v1"'
+
+
+def test_get_experiments(server, service):
+    projects = [{**PROJECT, 'id': '1'}, {**PROJECT, 'id': '2'}]
+    server.queue(make_response(body={'projects': projects}))
+    experiments = service.get_experiments(['2', '1'])
+    assert [experiment.md_uri for experiment in experiments] == ['2', '1']
+
+
+def test_get_experiments_single_project(server, service):
+    server.queue(make_response(body={'projects': PROJECT}))
+    assert service.get_experiments(['42'])[0].name == 'experiment'
+
+
+def test_workspace_experiments_single_project(server, service,
+                                              monkeypatch):
+    monkeypatch.setattr(data_cid, 'ijson', None)
+    body = json.dumps({'projects': PROJECT}).encode()
+    server.queue(make_stream_response(body))
+    experiments = service.get_workspace_experiments()
+    assert [experiment.md_uri for experiment in experiments] == ['42']
+
+
+def test_get_experiments_without_datasets(server, service):
+    project = {**PROJECT, 'datasets': [{'id': '1', 'label': 'data'}]}
+    server.queue(make_response(body={'projects': [PROJECT]}),
+                 make_response(body={'projects': [project]}))
+    service.get_experiments(['42'], include_datasets=False)
+    experiment = service.get_experiment('42')
+    assert len(server.calls) == 2
+    assert experiment.raw_dataset.name == 'data'
+
+
+def test_invalidate_experiment(server, service):
+    server.queue(make_response(body={'projects': [PROJECT]}),
+                 make_response(body={'projects': [PROJECT]}))
+    service.get_experiment('42')
+    service.invalidate_experiment('42')
+    service.get_experiment('42')
+    assert len(server.calls) == 2
+
+
+@pytest.fixture(params=['ijson', 'json'])
+def json_parser(request, monkeypatch):
+    if request.param == 'ijson':
+        if data_cid.ijson is None:
+            pytest.skip('ijson is not installed')
+    else:
+        monkeypatch.setattr(data_cid, 'ijson', None)
+    return request.param
+
+
+def test_workspace_experiments(server, service, json_parser):
+    # numbers have the same types as with json_loads, not Decimal
+    body = json.dumps({'projects': [{**PROJECT, 'id': 4.2}]}).encode()
+    server.queue(make_stream_response(body))
+    experiments = service.get_workspace_experiments()
+    assert [experiment.md_uri for experiment in experiments] == [4.2]
+    assert type(experiments[0].md_uri) is float
+
+
+def test_workspace_experiments_empty_body(server, service, json_parser):
+    server.queue(make_stream_response(b''))
+    with pytest.raises(DataServiceError):
+        service.get_workspace_experiments()